@@ -11,12 +11,11 @@
 # MAGIC ## 📌 Key Steps in This Notebook
 # MAGIC
 # MAGIC 1. **Generate a Billing FAQ Dataset**  
-# MAGIC    Create a synthetic dataset of frequently asked billing questions and answers, and save it as a Delta table in Unity Catalog.
+# MAGIC    Create a synthetic dataset of frequently asked billing questions and answers, embed them in batches with the embedding model endpoint, and save them as a Delta table in Unity Catalog with change data feed enabled.
 # MAGIC
 # MAGIC 2. **Configure & Create Vector Search Index**  
-# MAGIC    - Enable change data feed on the Delta table  
-# MAGIC    - Create a delta sync index using a specified embedding model  
-# MAGIC    - Wait for the index to become ready
+# MAGIC    - Create a delta sync index over the precomputed (self-managed) embeddings  
+# MAGIC    - Sync the index and wait until every source row is indexed
 # MAGIC
 # MAGIC 3. **Test the Vector Search**  
 # MAGIC    Run a similarity search using a sample query (`"Can I change my bill due date?"`) and return the top matching FAQ entries.
@@ -41,6 +40,23 @@
 
 # COMMAND ----------
 
+# DBTITLE 1,Imports
+import functools
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pyspark.sql.types import StructType, StructField, IntegerType, StringType, ArrayType, FloatType
+from databricks.sdk import WorkspaceClient
+from databricks.sdk.errors import ResourceAlreadyExists, AlreadyExists, ResourceConflict
+from databricks.sdk.service.vectorsearch import (
+    EndpointType, VectorIndexType, PipelineType, DeltaSyncVectorIndexSpecRequest, EmbeddingVectorColumn
+)
+from databricks.vector_search.client import VectorSearchClient
+
+# COMMAND ----------
+
 # DBTITLE 1,Setup Vector Search Index Configuration
 # TODO: Change config to your catalog, schema, etc 
 CATALOG = config['catalog']
@@ -54,10 +70,7 @@ vs_index_fullname = f"{CATALOG}.{SCHEMA}.{VS_INDX}"
 # COMMAND ----------
 
 # DBTITLE 1,Create Billing FAQ Dataset and Save as Delta Table
-import pandas as pd
-from pyspark.sql import SparkSession
-
-# Create a Pandas DataFrame from the CSV-like input
+# Create the FAQ rows from the CSV-like input
 faq_data = [
     (1, "Q: How is my bill calculated? A: Your bill includes your monthly plan fee, additional charges for extra services, taxes, and any applicable discounts. A detailed breakdown is available in your MyTelco account."),
     (2, "Q: Why is my bill higher than usual? A: Your bill may be higher due to extra data usage, international calls, roaming charges, or a recent plan change. Check the usage details in the MyTelco app."),
@@ -71,12 +84,37 @@ faq_data = [
     (10, "Q: Can I change my bill due date? A: Yes, you can request a bill due date change by contacting customer support or modifying it in your account settings.")
 ]
 
-# Convert to Pandas then Spark DataFrame
-pdf = pd.DataFrame(faq_data, columns=["index", "faq"])
-spark_df = SparkSession.builder.getOrCreate().createDataFrame(pdf)
-
-# Save as a Delta table
-spark_df.write.format("delta").mode("overwrite").saveAsTable(f"{CATALOG}.{SCHEMA}.billing_faq_dataset")
+# Embed texts with the embedding model endpoint, sending one request per batch instead of one per row
+EMBEDDING_BATCH_SIZE = 64
+
+w = WorkspaceClient()
+
+def embed_texts(texts):
+  embeddings = []
+  for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+    batch = texts[start:start + EMBEDDING_BATCH_SIZE]
+    response = w.serving_endpoints.query(name=embedding_model_endpoint_name, input=batch)
+    embeddings.extend(item.embedding for item in sorted(response.data, key=lambda d: d.index))
+  return embeddings
+
+# Build the Spark DataFrame directly from the rows, without a Pandas round-trip
+faq_schema = StructType([
+  StructField("index", IntegerType(), False),
+  StructField("faq", StringType(), True),
+  StructField("faq_embedding", ArrayType(FloatType()), True),
+])
+faq_embeddings = embed_texts([faq for _, faq in faq_data])
+EMBEDDING_DIMENSION = len(faq_embeddings[0])  # Taken from the configured model's output rather than hard-coded
+spark_df = spark.createDataFrame(
+  [(index, faq, embedding) for (index, faq), embedding in zip(faq_data, faq_embeddings)],
+  schema=faq_schema
+)
+
+# Save as a Delta table with change data feed enabled from the first commit, as required by the vector search index
+spark_df.write.format("delta") \
+  .mode("overwrite") \
+  .option("delta.enableChangeDataFeed", "true") \
+  .saveAsTable(f"{CATALOG}.{SCHEMA}.billing_faq_dataset")
 
 # COMMAND ----------
 
@@ -84,83 +122,130 @@ spark_df.write.format("delta").mode("overwrite").saveAsTable(f"{CATALOG}.{SCHEMA
 sql_query = f"""
 SELECT * FROM `{CATALOG}`.`{SCHEMA}`.`billing_faq_dataset`
 """
-display(spark.sql(sql_query))
+
+# Only render the table in interactive runs; in jobs a row count is enough to verify the write.
+is_interactive = dbutils.notebook.entry_point.getDbutils().notebook().getContext().tags().get("jobId").isEmpty()
+if is_interactive:
+  display(spark.sql(sql_query))
+else:
+  print(f"billing_faq_dataset contains {spark.sql(sql_query).count()} rows")
 
 # COMMAND ----------
 
-# DBTITLE 1,Create Vector Search Endpoint with Databricks Client
-from databricks.vector_search.client import VectorSearchClient
-from databricks.sdk.errors import ResourceAlreadyExists, AlreadyExists, ResourceConflict
+# DBTITLE 1,Initialize Vector Search Client
+# Initialize the Vector Search Client once, with the option to disable the notice, and reuse it for all index calls.
+vsc = VectorSearchClient(disable_notice=True)
 
-client = VectorSearchClient()
+# COMMAND ----------
 
+# DBTITLE 1,Create Vector Search Endpoint with Databricks Client
+# Create resources through the Databricks SDK, which raises typed errors (the VectorSearchClient only raises a generic Exception).
 try:
-    client.create_endpoint_and_wait(
+    w.vector_search_endpoints.create_endpoint_and_wait(
         name=VECTOR_SEARCH_ENDPOINT_NAME,
-        endpoint_type="STANDARD"
+        endpoint_type=EndpointType.STANDARD
     )
-except Exception as e:
-    msg = str(e)
-    if '"error_code":"ALREADY_EXISTS"' in msg or "status_code 409" in msg:
-        print(f"Endpoint {VECTOR_SEARCH_ENDPOINT_NAME} already exists. Continuing...")
-    else:
-        raise
-
-# COMMAND ----------
-
-# DBTITLE 1,Initialize Vector Search Client
-from databricks.vector_search.client import VectorSearchClient
-from databricks.sdk import WorkspaceClient
-import databricks.sdk.service.catalog as c
-import time
-
-# Initialize the Vector Search Client with the option to disable the notice.
-vsc = VectorSearchClient(disable_notice=True)
-
+except (ResourceAlreadyExists, AlreadyExists, ResourceConflict):
+    print(f"Endpoint {VECTOR_SEARCH_ENDPOINT_NAME} already exists. Continuing...")
 
 # COMMAND ----------
 
 # DBTITLE 1,Create and Sync Vector Search Index for FAQ Dataset
-# This allows us to create a vector search index on the table
-sql_query = f"""
-ALTER TABLE `{CATALOG}`.`{SCHEMA}`.`billing_faq_dataset` 
-SET TBLPROPERTIES (delta.enableChangeDataFeed = true)
-"""
-spark.sql(sql_query)
-
 vs_index = vs_index_fullname
 source_table = f"{CATALOG}.{SCHEMA}.billing_faq_dataset"
 
 primary_key = "index"
-embedding_source_column = "faq"
+embedding_vector_column = "faq_embedding"
 
-print(f"Creating index {vs_index} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
+# Each get_index call issues a describe request, so memoize the handle per (endpoint, index).
+@functools.lru_cache(maxsize=8)
+def get_index_handle(endpoint_name, index_name):
+  return vsc.get_index(endpoint_name, index_name)
 
-# Create a new delta sync index on the vector search endpoint.
-# This index is created from a source Delta table and is kept in sync with the source table.
-try:
-  index = vsc.create_delta_sync_index(
+# Decide up front whether to create or reuse the index, instead of issuing a create call and handling the conflict.
+existing_indexes = {
+  i.name: i for i in w.vector_search_indexes.list_indexes(endpoint_name=VECTOR_SEARCH_ENDPOINT_NAME)
+}
+
+if vs_index not in existing_indexes:
+  print(f"Creating index {vs_index} on endpoint {VECTOR_SEARCH_ENDPOINT_NAME}...")
+
+  # Create a new delta sync index on the vector search endpoint.
+  # This index is created from a source Delta table and is kept in sync with the source table.
+  w.vector_search_indexes.create_index(
+    name=vs_index,  # The name of the index to create.
     endpoint_name=VECTOR_SEARCH_ENDPOINT_NAME,  # The name of the vector search endpoint.
-    index_name=vs_index,  # The name of the index to create.
-    source_table_name=source_table,  # The full name of the source Delta table.
-    pipeline_type="TRIGGERED",  # The type of pipeline to keep the index in sync with the source table.
     primary_key=primary_key,  # The primary key column of the source table.
-    embedding_source_column=embedding_source_column,  # The column to use for generating embeddings.
-    embedding_model_endpoint_name=embedding_model_endpoint_name  # The name of the embedding model endpoint.
+    index_type=VectorIndexType.DELTA_SYNC,
+    delta_sync_index_spec=DeltaSyncVectorIndexSpecRequest(
+      source_table=source_table,  # The full name of the source Delta table.
+      pipeline_type=PipelineType.TRIGGERED,  # Sync on demand; use PipelineType.CONTINUOUS to tail the change data feed instead.
+      embedding_vector_columns=[
+        EmbeddingVectorColumn(
+          name=embedding_vector_column,  # The column holding the precomputed embeddings.
+          embedding_dimension=EMBEDDING_DIMENSION  # The dimension of the precomputed embeddings.
+        )
+      ]
+    )
   )
-  # Wait for index to come online. Expect this command to take several minutes.
-  while not index.describe().get('status').get('detailed_state').startswith('ONLINE'):
-    print("Waiting for index to be ONLINE...")
-    time.sleep(5)
-    
-  print(f"index {vs_index} on table {source_table} is ready")
-  
-except Exception as e:
-    msg = str(e)
-    if '"error_code":"RESOURCE_ALREADY_EXISTS"' in msg or "status_code 409" in msg:
-        print(f"Index {vs_index} already exists. Continuing...")
-    else:
-        raise
+  # A new triggered index runs its initial sync as part of creation.
+  print(f"Index {vs_index} created, waiting for initial sync...")
+  # Use an uncached handle while waiting; a provisioning index has no data-plane URL yet.
+  index = vsc.get_index(VECTOR_SEARCH_ENDPOINT_NAME, vs_index)
+
+else:
+  # Refuse to silently reuse an index built over a different source table, primary key or embedding column,
+  # e.g. one with model-managed embeddings on the faq column.
+  index = vsc.get_index(VECTOR_SEARCH_ENDPOINT_NAME, vs_index)
+  existing_spec = index.describe().get('delta_sync_index_spec', {})
+  existing_source_table = existing_spec.get('source_table')
+  existing_embedding_columns = [
+    (column.get('name'), column.get('embedding_dimension'))
+    for column in existing_spec.get('embedding_vector_columns', [])
+  ]
+  expected_embedding_columns = [(embedding_vector_column, EMBEDDING_DIMENSION)]
+  if (
+    existing_indexes[vs_index].primary_key != primary_key
+    or existing_source_table != source_table
+    or existing_embedding_columns != expected_embedding_columns
+  ):
+    raise ValueError(
+      f"Index {vs_index} already exists on {existing_source_table} with primary key "
+      f"{existing_indexes[vs_index].primary_key} and embedding vector columns {existing_embedding_columns}; "
+      f"expected {source_table} with primary key {primary_key} and embedding vector columns {expected_embedding_columns}. "
+      f"Delete the index or choose a different vector_search_index name."
+    )
+
+  # The source table was just overwritten, so an existing triggered index needs an explicit sync.
+  print(f"Index {vs_index} already exists. Triggering sync...")
+  index.sync()
+
+# Wait until the index has processed the source table's latest Delta commit, i.e. the overwrite above.
+# Expect this command to take several minutes.
+# Poll with exponential backoff (2s, 4s, 8s, ... capped at 30s), fail fast on terminal states and give up after the deadline.
+INDEX_SYNC_TIMEOUT_SECONDS = 60 * 60
+source_table_version = spark.sql(f"DESCRIBE HISTORY {source_table} LIMIT 1").first()["version"]
+deadline = time.monotonic() + INDEX_SYNC_TIMEOUT_SECONDS
+for delay in itertools.accumulate(itertools.repeat(2), lambda a, _: min(a * 2, 30)):
+  status = index.describe().get('status')
+  detailed_state = status.get('detailed_state')
+  if detailed_state.endswith('FAILED'):
+    raise RuntimeError(f"Index {vs_index} entered terminal state {detailed_state}")
+  processed_version = status.get('triggered_update_status', {}).get('last_processed_commit_version')
+  if status.get('ready') and processed_version is not None and processed_version >= source_table_version:
+    break
+  if time.monotonic() + delay > deadline:
+    raise TimeoutError(
+      f"Index {vs_index} did not process version {source_table_version} of {source_table} "
+      f"within {INDEX_SYNC_TIMEOUT_SECONDS}s (state: {detailed_state}, processed version: {processed_version})"
+    )
+  print(f"Waiting for index sync (state: {detailed_state}, processed version {processed_version}/{source_table_version}), retrying in {delay}s...")
+  time.sleep(delay)
+
+print(f"index {vs_index} on table {source_table} is ready")
+
+# Bind the index handle once the index is ready, so the cached handle targets its data-plane URL, and reuse it for every query below.
+index_handle = get_index_handle(VECTOR_SEARCH_ENDPOINT_NAME, vs_index)
 
 # COMMAND ----------
 
@@ -170,25 +255,77 @@ except Exception as e:
 # Define the query text for the similarity search.
 query_text = "Can I change my bill due date"
 
-# Perform a similarity search on the vector search index.
-results = vsc.get_index(VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname).similarity_search(
-  query_text=query_text,
-  columns=['index', 'faq'],
-  query_type="ANN",
-  num_results=5)  # Specify the number of results to return.
-
-results
+# Embed each unique query once on the client, so ANN and hybrid searches for the same text share one embedding call.
+# lru_cache does not coalesce concurrent misses, so callers asking for the same text wait on the first caller's Future;
+# the lock only guards the in-flight map, so different queries embed in parallel.
+_embed_query_lock = threading.Lock()
+_embed_query_in_flight = {}
+
+@functools.lru_cache(maxsize=1024)
+def _embed_query_cached(query_text):
+  return tuple(embed_texts([query_text])[0])
+
+def embed_query(query_text):
+  with _embed_query_lock:
+    future = _embed_query_in_flight.get(query_text)
+    is_owner = future is None
+    if is_owner:
+      future = _embed_query_in_flight[query_text] = Future()
+  if is_owner:
+    try:
+      future.set_result(_embed_query_cached(query_text))
+    except Exception as e:
+      future.set_exception(e)
+    finally:
+      with _embed_query_lock:
+        del _embed_query_in_flight[query_text]
+  return future.result()
+
+# Fetch the FAQ text for the final candidates only, preserving their ranking order.
+def fetch_faqs(candidates):
+  if not candidates:
+    return ()
+  ids = ", ".join(str(int(index)) for index, _ in candidates)
+  faqs = dict(spark.sql(
+    f"SELECT `index`, faq FROM `{CATALOG}`.`{SCHEMA}`.`billing_faq_dataset` WHERE `index` IN ({ids})"
+  ).collect())
+  return tuple((int(index), faqs.get(int(index)), score) for index, score in candidates)
+
+# Cache results per (query, query type, number of results, number of candidates, reranker) so repeated FAQ questions skip the embedding and search calls.
+# For a multi-process service, replace lru_cache with a shared cache such as Redis, keyed the same way with a TTL.
+@functools.lru_cache(maxsize=1024)
+def _search_cached(query_text, query_type, num_results, num_candidates, reranker):
+  # First pass: retrieve only candidate ids and scores, so the response does not carry the full FAQ text.
+  results = index_handle.similarity_search(
+    query_text=query_text if query_type == "hybrid" else None,  # Hybrid search also needs the raw text for keyword matching.
+    query_vector=list(embed_query(query_text)),  # The index holds self-managed embeddings, so pass the client-side query embedding.
+    columns=['index'],
+    query_type=query_type,
+    num_results=num_candidates)  # Specify the number of candidates to return.
+  candidates = results.get('result', {}).get('data_array', [])
+  # Candidates arrive ordered by score; an optional reranker reorders them as (index, score) pairs before truncation.
+  if reranker is not None:
+    candidates = reranker(query_text, candidates)
+  return fetch_faqs(candidates[:num_results])
+
+def search_cached(query_text, query_type="ANN", num_results=5, reranker=None, num_candidates=None):
+  # Only over-fetch candidates when a reranker can make use of them.
+  if num_candidates is None:
+    num_candidates = num_results if reranker is None else 4 * num_results
+  # Normalize the query so trivially different phrasings of the same FAQ share a cache entry.
+  return _search_cached(query_text.strip().lower(), query_type, num_results, num_candidates, reranker)
+
+# Perform the ANN and hybrid similarity searches concurrently, since both are I/O-bound REST calls.
+with ThreadPoolExecutor(max_workers=2) as executor:
+  ann_future = executor.submit(search_cached, query_text, "ANN", 5)
+  hybrid_future = executor.submit(search_cached, query_text, "hybrid", 5)
+  ann_results, hybrid_results = ann_future.result(), hybrid_future.result()
+
+ann_results
 
 # COMMAND ----------
 
-# Perform a similarity search on the vector search index.
-results = vsc.get_index(VECTOR_SEARCH_ENDPOINT_NAME, vs_index_fullname).similarity_search(
-  query_text=query_text,
-  columns=['index', 'faq'],
-  query_type="hybrid",
-  num_results=5)  # Specify the number of results to return.
-
-results
+hybrid_results
 
 # COMMAND ----------
 